@@ -1,12 +1,62 @@
 import tradingview_screener as tvs
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 from scipy import stats
 import akshare as ak
 import time
+import functools
 import glob
-import json
 import os
+import orjson
+from datetime import datetime, timedelta
+
+
+# TradingView 查询结果本地缓存有效期（小时）
+TVS_CACHE_TTL_HOURS = 6
+
+# 本地parquet文件统一使用 zstd 压缩（pandas.to_parquet 与 pyarrow.parquet.write_table 共用）
+PARQUET_OPTIONS = {'compression': 'zstd', 'compression_level': 3}
+
+
+def parse_file_timestamp(filename, prefix):
+    """从 <prefix>YYYYMMDD_HHMMSS.parquet 文件名中解析时间戳，格式不符时返回None"""
+    stamp = os.path.basename(filename).removeprefix(prefix).removesuffix('.parquet')
+    try:
+        return datetime.strptime(stamp, "%Y%m%d_%H%M%S")
+    except ValueError:
+        return None
+
+
+def load_broad_data(broad_query):
+    """加载TradingView选股数据，缓存未过期时直接读取本地parquet文件"""
+    # 只考虑文件名带有效时间戳的缓存，其他文件忽略
+    cache_files = [
+        (cached_at, filename)
+        for filename in glob.glob("stock_data/tvs_broad_*.parquet")
+        if (cached_at := parse_file_timestamp(filename, 'tvs_broad_')) is not None
+    ]
+
+    if cache_files:
+        cached_at, latest_cache_file = max(cache_files)
+
+        if datetime.now() - cached_at < timedelta(hours=TVS_CACHE_TTL_HOURS):
+            broad_data = pd.read_parquet(latest_cache_file)
+            print(f"Loaded cached TradingView data from {latest_cache_file}")
+            return len(broad_data), broad_data
+
+    print("TradingView cache missing or expired. Fetching new data...")
+    broad_count, broad_data = broad_query.get_scanner_data()
+
+    if not broad_data.empty:
+        # 保存查询结果到本地parquet文件，注明时间戳
+        timestamp = time.strftime("%Y%m%d_%H%M%S")
+        cache_file = f"stock_data/tvs_broad_{timestamp}.parquet"
+        broad_data.to_parquet(cache_file, index=False, **PARQUET_OPTIONS)
+        print(f"Saved new TradingView data to {cache_file}")
+
+    return broad_count, broad_data
 
 
 def focused_fcf_turnover_screener():
@@ -50,33 +100,30 @@ def focused_fcf_turnover_screener():
         .limit(3000)
     )
 
-    broad_count, broad_data = broad_query.get_scanner_data()
+    broad_count, broad_data = load_broad_data(broad_query)
 
     if broad_data.empty:
         print("未获取到足够数据进行行业分析")
         return 0, pd.DataFrame()
 
-    # 行业标准化函数
+    # 分类列转为 category，加快行业分组与后续映射
+    for column in ('sector', 'industry', 'exchange'):
+        broad_data[column] = broad_data[column].astype('category')
+
+    # 行业标准化函数 - 只返回各指标的行业排名列
     def industry_normalization(df, metrics):
-        normalized_df = df.copy()
-
-        for sector in df['sector'].unique():
-            sector_mask = df['sector'] == sector
-            sector_data = df[sector_mask]
-
-            for metric in metrics:
-                if metric in df.columns:
-                    sector_values = sector_data[metric].dropna()
-                    if len(sector_values) > 5:
-                        normalized_df.loc[sector_mask, f'{metric}_industry_rank'] = (
-                            sector_data[metric].rank(pct=True) * 100
-                        )
-                    else:
-                        normalized_df.loc[sector_mask, f'{metric}_industry_rank'] = (
-                            df[metric].rank(pct=True) * 100
-                        )
-
-        return normalized_df
+        metrics = [metric for metric in metrics if metric in df.columns]
+
+        # 行业内百分位排名；行业样本不超过5个时退回全市场排名
+        sector_groups = df.groupby('sector', observed=True)[metrics]
+        sector_ranks = sector_groups.rank(pct=True) * 100
+        global_ranks = df[metrics].rank(pct=True) * 100
+        sector_sizes = sector_groups.transform('count')
+
+        ranks = sector_ranks.where(sector_sizes > 5, global_ranks)
+        # 没有行业的股票不参与排名（保持为NaN），不能退回全市场排名
+        ranks = ranks.where(df['sector'].notna(), axis=0)
+        return ranks.add_suffix('_industry_rank')
 
     # 核心指标 + 验证指标
     key_metrics = [
@@ -97,180 +144,144 @@ def focused_fcf_turnover_screener():
     ]
 
     # 应用行业标准化
-    normalized_data = industry_normalization(broad_data, key_metrics)
+    # 只把行业和参与排名的指标交给标准化函数，避免复制整张宽表
+    industry_ranks = industry_normalization(
+        broad_data.filter(items=['sector'] + key_metrics), key_metrics
+    )
+    normalized_data = broad_data.join(industry_ranks)
+
+    # 行业排名需要全样本，但与排名无关的硬性条件可以先过滤，评分只在剩余股票上计算
+    hard_filters = normalized_data.eval(
+        'market_cap_basic > 5000000000'  # 市值 > 50亿
+        ' and free_cash_flow_margin_ttm > 0.05'  # FCF边际 > 5%
+        ' and asset_turnover_current > 0.2'  # 资产周转率 > 0.2
+        ' and net_income_yoy_growth_ttm > 0'  # 净利润增长为正
+        ' and total_revenue_yoy_growth_ttm > 0'  # 收入增长为正
+    )
+    candidates = normalized_data.loc[hard_filters].copy()
+
+    def rank_array(df, metrics):
+        """取出行业排名列为连续的float数组 (行 × 指标)，缺失值保留为NaN"""
+        columns = [f'{metric}_industry_rank' for metric in metrics]
+        return df[columns].to_numpy(dtype=np.float64)
+
+    # 🎯 核心策略指标 (70%) + ✅ 盈利质量验证 (15%) + 📈 增长验证 (10%)
+    # (指标, 权重, 得分上限)
+    focused_components = [
+        ('free_cash_flow_margin_ttm', 0.35, 35),      # FCF边际行业排名 (35%)
+        ('asset_turnover_current', 0.35, 35),         # 资产周转率行业排名 (35%)
+        ('operating_margin', 0.10, 10),               # 运营利润率行业排名 (10%)
+        ('return_on_equity', 0.05, 5),                # ROE行业排名 (5%)
+        ('total_revenue_yoy_growth_ttm', 0.05, 5),    # 收入增长行业排名 (5%)
+        ('net_income_yoy_growth_ttm', 0.05, 5),       # 净利润增长行业排名 (5%)
+    ]
 
-    def calculate_focused_score(row):
+    def calculate_focused_score(df):
         """
-        专注FCF边际和资产周转率的评分体系
+        专注FCF边际和资产周转率的评分体系（在numpy数组上整体计算）
+
+        核心指标任一行业排名缺失时得分为NaN，该股票不会通过核心评分筛选
         """
-        score = 0
-
-        try:
-            # 🎯 核心策略指标 - 70%权重
-            # FCF边际行业排名 (35%)
-            fcf_rank = row.get('free_cash_flow_margin_ttm_industry_rank', 0)
-            score += min(fcf_rank * 0.35, 35)
-
-            # 资产周转率行业排名 (35%)
-            turnover_rank = row.get('asset_turnover_current_industry_rank', 0)
-            score += min(turnover_rank * 0.35, 35)
-
-            # ✅ 盈利质量验证 - 15%权重
-            # 运营利润率行业排名 (10%)
-            op_margin_rank = row.get('operating_margin_industry_rank', 0)
-            score += min(op_margin_rank * 0.10, 10)
-
-            # ROE行业排名 (5%)
-            roe_rank = row.get('return_on_equity_industry_rank', 0)
-            score += min(roe_rank * 0.05, 5)
-
-            # 📈 增长验证 - 10%权重
-            # 收入增长行业排名 (5%)
-            revenue_growth_rank = row.get('total_revenue_yoy_growth_ttm_industry_rank', 0)
-            score += min(revenue_growth_rank * 0.05, 5)
-
-            # 净利润增长行业排名 (5%)
-            net_income_growth_rank = row.get('net_income_yoy_growth_ttm_industry_rank', 0)
-            score += min(net_income_growth_rank * 0.05, 5)
-
-            # 💰 估值合理性验证 - 5%权重
-            # PEG行业排名 (反向指标，越低越好)
-            if pd.notna(row.get('price_earnings_growth_ttm_industry_rank')):
-                peg_rank = row['price_earnings_growth_ttm_industry_rank']
-                # PEG < 1 通常被认为是合理的
-                if row.get('price_earnings_growth_ttm', 999) < 1.5:
-                    score += 5
-                elif row.get('price_earnings_growth_ttm', 999) < 2:
-                    score += 3
-                else:
-                    score += 1
-            else:
-                # 如果没有PEG数据，用PE判断
-                pe_rank = row.get('price_earnings_ttm_industry_rank', 50)
-                pe_score = max(0, (100 - pe_rank) * 0.05)  # PE越低越好
-                score += min(pe_score, 5)
-
-        except (ValueError, TypeError):
-            return 0
-
-        return min(score, 100)
+        metrics, weights, caps = map(np.array, zip(*focused_components))
+        score = np.minimum(rank_array(df, metrics) * weights, caps).sum(axis=1)
+
+        # 💰 估值合理性验证 - 5%权重
+        # PEG < 1 通常被认为是合理的
+        peg = df['price_earnings_growth_ttm'].to_numpy(dtype=np.float64)
+        peg_score = np.select([peg < 1.5, peg < 2], [5, 3], default=1)
+        # 如果没有PEG数据，用PE判断 (PE越低越好)，PE排名也缺失时不加分
+        pe_rank = rank_array(df, ['price_earnings_ttm'])[:, 0]
+        pe_score = np.minimum(np.fmax(0, (100 - pe_rank) * 0.05), 5)
+        has_peg_rank = df['price_earnings_growth_ttm_industry_rank'].notna().to_numpy()
+        score += np.where(has_peg_rank, peg_score, pe_score)
+
+        return pd.Series(np.minimum(score, 100), index=df.index)
 
     # 应用专注评分
-    normalized_data['focused_fcf_turnover_score'] = normalized_data.apply(
-        calculate_focused_score, axis=1
-    )
+    candidates['focused_fcf_turnover_score'] = calculate_focused_score(candidates)
 
     # 计算核心组合指标
-    normalized_data['fcf_turnover_composite'] = (
-        normalized_data['free_cash_flow_margin_ttm_industry_rank'] * 0.6 +
-        normalized_data['asset_turnover_current_industry_rank'] * 0.4
+    candidates['fcf_turnover_composite'] = (
+        candidates['free_cash_flow_margin_ttm_industry_rank'] * 0.6 +
+        candidates['asset_turnover_current_industry_rank'] * 0.4
     )
 
     # 验证指标组合
-    def calculate_validation_score(row):
-        """计算验证指标得分，用于确认盈利质量和估值"""
-        validation_score = 0
+    def calculate_validation_score(df):
+        """计算验证指标得分，用于确认盈利质量和估值（在numpy数组上整体计算）
 
+        任一参与计算的行业排名缺失时得分为NaN，该股票不会通过验证评分筛选
+        """
         # 盈利质量验证 (60%)
-        op_margin_rank = row.get('operating_margin_industry_rank', 0)
-        roe_rank = row.get('return_on_equity_industry_rank', 0)
-        revenue_growth_rank = row.get('total_revenue_yoy_growth_ttm_industry_rank', 0)
-
-        profitability_quality = (op_margin_rank + roe_rank + revenue_growth_rank) / 3
-        validation_score += profitability_quality * 0.6
+        profitability_quality = rank_array(
+            df, ['operating_margin', 'return_on_equity', 'total_revenue_yoy_growth_ttm']
+        ).mean(axis=1)
+        validation_score = profitability_quality * 0.6
 
         # 财务健康验证 (20%)
-        debt_rank = row.get('debt_to_equity_industry_rank', 50)
-        financial_health = (100 - debt_rank)  # 负债越低越好
-        validation_score += financial_health * 0.2
+        debt_rank = rank_array(df, ['debt_to_equity'])[:, 0]
+        validation_score += (100 - debt_rank) * 0.2  # 负债越低越好
 
         # 估值验证 (20%)
-        if pd.notna(row.get('price_earnings_growth_ttm')):
-            peg = row['price_earnings_growth_ttm']
-            if peg < 1:
-                valuation_score = 100
-            elif peg < 1.5:
-                valuation_score = 80
-            elif peg < 2:
-                valuation_score = 60
-            else:
-                valuation_score = 40
-        else:
-            pe_rank = row.get('price_earnings_ttm_industry_rank', 50)
-            valuation_score = 100 - pe_rank  # PE越低越好
-
+        peg = df['price_earnings_growth_ttm'].to_numpy(dtype=np.float64)
+        peg_score = np.select([peg < 1, peg < 1.5, peg < 2], [100, 80, 60], default=40)
+        pe_score = 100 - rank_array(df, ['price_earnings_ttm'])[:, 0]  # PE越低越好
+        valuation_score = np.where(np.isnan(peg), pe_score, peg_score)
         validation_score += valuation_score * 0.2
 
-        return min(validation_score, 100)
+        return pd.Series(np.minimum(validation_score, 100), index=df.index)
 
-    normalized_data['validation_score'] = normalized_data.apply(
-        calculate_validation_score, axis=1
-    )
+    candidates['validation_score'] = calculate_validation_score(candidates)
 
     # 🎯 最终筛选条件 - 更加专注核心指标
-    screening_criteria = (
-        (normalized_data['focused_fcf_turnover_score'] >= 70) &  # 核心评分 >= 70
-        (normalized_data['fcf_turnover_composite'] >= 70) &  # FCF周转组合排名前30%
-        (normalized_data['validation_score'] >= 60) &  # 验证评分及格
-        (normalized_data['market_cap_basic'] > 5000000000) &  # 市值 > 50亿
-        (normalized_data['free_cash_flow_margin_ttm'] > 0.05) &  # FCF边际 > 5%
-        (normalized_data['asset_turnover_current'] > 0.2) &  # 资产周转率 > 0.2
-        (normalized_data['net_income_yoy_growth_ttm'] > 0) &  # 净利润增长为正
-        (normalized_data['total_revenue_yoy_growth_ttm'] > 0)  # 收入增长为正
+    # 整个条件作为一个表达式求值，安装了numexpr时会融合为单次遍历
+    screening_criteria = candidates.eval(
+        'focused_fcf_turnover_score >= 70'  # 核心评分 >= 70
+        ' and fcf_turnover_composite >= 70'  # FCF周转组合排名前30%
+        ' and validation_score >= 60'  # 验证评分及格
     )
 
-    screened_stocks = normalized_data[screening_criteria].copy()
+    # 筛选后直接按核心评分和FCF周转组合排序
+    # sort_values 本身返回新的DataFrame，无需再额外 copy 一次
+    screened_stocks = candidates.loc[screening_criteria].sort_values(
+        by=['focused_fcf_turnover_score', 'fcf_turnover_composite'],
+        ascending=[False, False]
+    )
 
     if screened_stocks.empty:
         print("未找到符合核心策略的优质股票")
         return 0, pd.DataFrame()
 
-    # 按核心评分和FCF周转组合排序
-    screened_stocks = screened_stocks.sort_values(
-        by=['focused_fcf_turnover_score', 'fcf_turnover_composite'],
-        ascending=[False, False]
-    )
-
     # 添加投资逻辑标签
-    def get_investment_rationale(row):
-        rationale = []
-
-        fcf_margin_rank = row.get('free_cash_flow_margin_ttm_industry_rank', 0)
-        turnover_rank = row.get('asset_turnover_current_industry_rank', 0)
-        fcf_turnover_composite = row.get('fcf_turnover_composite', 0)
-        peg = row.get('price_earnings_growth_ttm', 999)
-        net_income_growth = row.get('net_income_yoy_growth_ttm', 0)
-
-        if fcf_margin_rank >= 80:
-            rationale.append("利润率领先")
-        elif fcf_margin_rank >= 60:
-            rationale.append("利润率优秀")
-
-        if turnover_rank >= 80:
-            rationale.append("资产周转领先")
-        elif turnover_rank >= 60:
-            rationale.append("资产周转优秀")
-
-        if fcf_turnover_composite >= 80:
-            rationale.append("现金流回报领先")
-        elif fcf_turnover_composite >= 60:
-            rationale.append("现金流回报优秀")
-
-        if peg < 1:
-            rationale.append("市盈增长率极具吸引力")
-        elif peg < 1.5:
-            rationale.append("市盈增长率合理")
-
-        if net_income_growth > 0.2:
-            rationale.append("高盈利增长")
-        elif net_income_growth > 0.1:
-            rationale.append("稳健盈利增长")
-
-        return " | ".join(rationale) if rationale else "符合基础标准"
-
-    screened_stocks['investment_rationale'] = screened_stocks.apply(
-        get_investment_rationale, axis=1
-    )
+    def get_investment_rationale(df):
+        fcf_margin_rank = df['free_cash_flow_margin_ttm_industry_rank']
+        turnover_rank = df['asset_turnover_current_industry_rank']
+        fcf_turnover_composite = df['fcf_turnover_composite']
+        peg = df['price_earnings_growth_ttm']
+        net_income_growth = df['net_income_yoy_growth_ttm']
+
+        # 每个维度最多贡献一个标签，缺失值不产生标签
+        labels = [
+            np.select([fcf_margin_rank >= 80, fcf_margin_rank >= 60],
+                      ["利润率领先", "利润率优秀"], default=""),
+            np.select([turnover_rank >= 80, turnover_rank >= 60],
+                      ["资产周转领先", "资产周转优秀"], default=""),
+            np.select([fcf_turnover_composite >= 80, fcf_turnover_composite >= 60],
+                      ["现金流回报领先", "现金流回报优秀"], default=""),
+            np.select([peg < 1, peg < 1.5],
+                      ["市盈增长率极具吸引力", "市盈增长率合理"], default=""),
+            np.select([net_income_growth > 0.2, net_income_growth > 0.1],
+                      ["高盈利增长", "稳健盈利增长"], default=""),
+        ]
+
+        # 行 × 维度 的标签矩阵，逐行拼接非空标签
+        label_matrix = np.stack(labels, axis=1)
+        rationale = [" | ".join(label for label in row if label) or "符合基础标准"
+                     for row in label_matrix]
+
+        return pd.Series(rationale, index=df.index)
+
+    screened_stocks['investment_rationale'] = get_investment_rationale(screened_stocks)
 
     # 选择输出列 - 更加专注核心指标
     output_columns = [
@@ -305,10 +316,13 @@ def focused_fcf_turnover_screener():
     return len(final_df), final_df
 
 
+# 与选股结果合并时用到的千股千评字段
+COMMENT_COLUMNS = ['代码', '名称','最新价','主力成本', '换手率','机构参与度', '综合得分',
+           '上升', '目前排名', '关注指数']
+
+
 def load_comment_data():
     """加载东方财富网千股千评数据"""
-    from datetime import datetime
-    
     # Get today's date in YYYYMMDD format
     today_date = datetime.now().strftime("%Y%m%d")
     today_file_pattern = f"stock_data/stock_comment_em_{today_date}_*.parquet"
@@ -317,14 +331,9 @@ def load_comment_data():
     today_files = glob.glob(today_file_pattern)
     
     if today_files:
-        # Use today's data - sort by timestamp and get the latest
-        def extract_timestamp(filename):
-            basename = os.path.basename(filename)
-            return basename.replace('stock_comment_em_', '').replace('.parquet', '')
-        
-        today_files.sort(key=extract_timestamp)
-        latest_today_file = today_files[-1]
-        stock_comment_em_df = pd.read_parquet(latest_today_file)
+        # Use today's data - fixed-width timestamps order lexicographically
+        latest_today_file = max(today_files, key=os.path.basename)
+        stock_comment_em_df = pd.read_parquet(latest_today_file, columns=COMMENT_COLUMNS)
         print(f"Loaded today's comment data from {latest_today_file}")
     else:
         print("Today's comment data not found. Fetching new data...")
@@ -334,12 +343,26 @@ def load_comment_data():
         # 保存千股千评数据到本地parquet文件，注明时间戳
         timestamp = time.strftime("%Y%m%d_%H%M%S")
         stock_comment_em_df = stock_comment_em_df.sort_values(by='目前排名')
-        stock_comment_em_df.to_parquet(f"stock_data/stock_comment_em_{timestamp}.parquet", index=False)
+        # 在parquet元数据中记录排序列，读取时可按 目前排名 跳过行组
+        table = pa.Table.from_pandas(stock_comment_em_df, preserve_index=False)
+        pq.write_table(
+            table,
+            f"stock_data/stock_comment_em_{timestamp}.parquet",
+            sorting_columns=[pq.SortingColumn(table.schema.get_field_index('目前排名'))],
+            **PARQUET_OPTIONS
+        )
         print(f"Saved new comment data to stock_data/stock_comment_em_{timestamp}.parquet")
 
     return stock_comment_em_df
 
 
+@functools.lru_cache(maxsize=1)
+def load_sector_map():
+    """加载行业中英文对照表（进程内只读取一次）"""
+    with open('stock_data/sector_translations.json', 'rb') as f:
+        return orjson.loads(f.read())
+
+
 def create_final_list():
     """生成最终股票列表并保存为parquet文件"""
 
@@ -388,24 +411,26 @@ def create_final_list():
     # 加载评论数据
     stock_comment_em_df = load_comment_data()
 
-    # 合并数据
-    combined_df = display_df.merge(
-        stock_comment_em_df[['代码', '名称','最新价','主力成本', '换手率','机构参与度', '综合得分',
-           '上升', '目前排名', '关注指数']].rename(columns={'代码': 'name'}),
-        on='name',
+    # 合并数据 - 6位股票代码转为整数作为连接键，避免字符串哈希
+    comment_df = stock_comment_em_df[COMMENT_COLUMNS]
+    combined_df = display_df.assign(_code=display_df['name'].astype('int32')).merge(
+        comment_df.assign(_code=comment_df['代码'].astype('int32')).drop(columns='代码'),
+        on='_code',
         how='left'
-    )
+    ).drop(columns='_code')
 
     # 映射行业到中文
-    with open('stock_data/sector_translations.json', 'r', encoding='utf-8') as f:
-        sector_map = json.load(f)
+    sector_map = load_sector_map()
 
-    combined_df['行业'] = combined_df['sector'].map(sector_map).fillna(combined_df['sector'])
+    combined_df['行业'] = combined_df['sector'].cat.rename_categories(
+        lambda sector: sector_map.get(sector, sector)
+    )
     combined_df['代码'] = combined_df['name']
 
     # 计算最终组合权重
-    combined_df['权重'] = combined_df['基本面评分'] * np.log(combined_df['市值（亿元）'])
-    combined_df['权重'] = combined_df['权重'] / combined_df['权重'].sum()
+    weights = combined_df['基本面评分'].to_numpy() * np.log(combined_df['市值（亿元）'].to_numpy())
+    weights /= np.nansum(weights)
+    combined_df['权重'] = weights
 
     # 构建最终列表
     final_columns = ['代码','名称','行业','基本面评分','投资理由',
@@ -431,12 +456,17 @@ def create_final_list():
     # 保存为parquet文件
     timestamp = time.strftime("%Y%m%d_%H%M%S")
     filename = f"stock_data/cn_stock_screening_{timestamp}.parquet"
-    final_list.to_parquet(filename, index=False)
+    final_list.to_parquet(filename, index=False, row_group_size=1024, **PARQUET_OPTIONS)
     print(f"\n✅ 最终列表已保存到: {filename}")
     
-    # 同时保存为JSON文件供网站使用
+    # 同时从内存中的同一DataFrame保存为JSON文件供网站使用（build.js 读取未压缩的 .json）
     json_filename = f"stock_data/cn_stock_screening_{timestamp}.json"
-    final_list.to_json(json_filename, orient='records', force_ascii=False, indent=2)
+    # orjson 直接输出UTF-8字节，NaN 序列化为 null
+    with open(json_filename, 'wb') as f:
+        f.write(orjson.dumps(
+            final_list.to_dict(orient='records'),
+            option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY
+        ))
     print(f"✅ JSON版本已保存到: {json_filename}")
 
     return final_list